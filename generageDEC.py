@@ -7,82 +7,266 @@ device enrollment codes (DEC) for each room using the Pulse API.
 
 Requirements:
 - python-dotenv
-- requests
+- httpx[http2]
+- orjson (optional, faster JSON parsing)
+- uvloop (optional, faster event loop on macOS/Linux, used from 0.18)
 
 Usage:
 1. Create a .env file with ORG_ID and API_KEY
-2. Run: python neat_pulse_enrollment_simple.py
+2. Run: python neat_pulse_enrollment_simple.py [--force]
 """
 
 import os
 import time
+import json
+import argparse
+import asyncio
 import csv
-import requests
-from typing import List, Dict, Optional
+import logging
+import operator
+from urllib.parse import urljoin
+import httpx
+from typing import AsyncIterator, Callable, List, Dict, Optional
 from dotenv import load_dotenv
 
+try:
+    from orjson import loads as json_loads  # Decodes response bytes in C
+except ImportError:
+    from json import loads as json_loads
+
+BULK_BATCH_SIZE = 50  # Rooms per bulk regenerate_dec request
+QUEUE_SIZE = 128  # Rooms buffered between the room listing and DEC generation
+MAX_RETRIES = 5  # Retries per request on transient failures
+RETRY_BACKOFF_FACTOR = 0.5  # Seconds, doubled on every retry
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+ROOMS_KEYS = ('rooms', 'data', 'items')  # Keys the room list may be nested under
+DEC_CACHE_FILE = ".dec_cache.json"  # DECs already generated, by org and room ID
+CSV_HEADER = ('room_name', 'room_id', 'device_enrollment_code')
+
+log = logging.getLogger(__name__)
+
 
 class NeatPulseClient:
     """Simplified client for NEAT Pulse API"""
     
-    def __init__(self, api_key: str, org_id: str):
+    def __init__(self, api_key: str, org_id: str, concurrency: int = 8, rate: float = 10.0):
         self.api_key = api_key
         self.org_id = org_id
         self.base_url = "https://api.pulse.neat.no/v1"
+        self._rooms_url = f"{self.base_url}/orgs/{org_id}/rooms"  # Built once, not per request
         self.headers = {
             'Authorization': f'Bearer {api_key}',
             'Content-Type': 'application/json',
             'Accept': 'application/json'
         }
+        # One HTTP/2 client so all room requests multiplex over a single connection
+        self.client = httpx.AsyncClient(
+            headers=self.headers,
+            http2=True,
+            # Keep idle connections past the longest rate limit backoff (60s), so
+            # pauses don't force a fresh DNS lookup and TLS handshake
+            limits=httpx.Limits(max_connections=16, max_keepalive_connections=16, keepalive_expiry=75.0),
+            timeout=30.0
+        )
+        self._sem = asyncio.Semaphore(concurrency)  # Bound in-flight requests
+        # Adaptive rate limiting: widened on 429 / Retry-After, decays back on success
+        self._base_interval = 1.0 / rate
+        self._min_interval = self._base_interval
+        self._next_allowed = 0.0
+        self._last_adjusted = 0.0  # When the interval was last widened
+        self._rooms_key: Optional[str] = None  # Key holding rooms in listing responses
+        self._rooms_shape_known = False
+        self._bulk_supported = True  # Cleared once the bulk endpoint is found missing
+        self._bulk_confirmed = False  # Set once a bulk request has succeeded
+        self._bulk_probe = asyncio.Lock()
+    
+    async def close(self) -> None:
+        """Close the underlying HTTP client"""
+        await self.client.aclose()
+    
+    async def _rate_limit(self) -> None:
+        """Wait for the next request slot, sleeping only when needed"""
+        # Slots are taken on wake-up rather than reserved ahead, so waiters pick
+        # up a shortened interval and don't stack up behind a widened one
+        # (no await between check and update, so this is atomic on the event loop)
+        while True:
+            now = time.monotonic()
+            if now >= self._next_allowed:
+                self._next_allowed = now + self._min_interval
+                return
+            await asyncio.sleep(self._next_allowed - now)
     
-    def _make_request(self, method: str, endpoint: str) -> requests.Response:
-        """Make API request with basic error handling"""
-        time.sleep(1)  # Simple rate limiting
+    def _update_rate_limit(self, response: httpx.Response, sent_at: float) -> None:
+        """Adjust pacing from the response status and rate limit headers
         
-        url = f"{self.base_url}/{endpoint}"
-        response = requests.request(method, url, headers=self.headers)
-        response.raise_for_status()
-        return response
+        A Retry-After header sets the pause directly. Otherwise throttling widens
+        the interval, but only for requests sent after the last widening, so a
+        burst of concurrent 429s backs off once rather than once per response.
+        """
+        retry_after = None
+        try:
+            retry_after = float(response.headers.get('Retry-After', ''))
+        except ValueError:
+            pass  # Missing, or in HTTP-date form
+        remaining = response.headers.get('X-RateLimit-Remaining')
+        current = sent_at >= self._last_adjusted
+        
+        if response.status_code != 429 and remaining != '0':
+            if current:
+                self._min_interval = max(self._min_interval / 2, self._base_interval)
+            if retry_after is None:
+                return
+        elif retry_after is None and current:
+            self._min_interval = min(self._min_interval * 2, 60.0)
+            self._last_adjusted = time.monotonic()
+        
+        delay = self._min_interval if retry_after is None else retry_after
+        self._next_allowed = max(self._next_allowed, time.monotonic() + delay)
     
-    def get_rooms(self) -> List[Dict]:
-        """Fetch all rooms for the organization"""
-        endpoint = f"orgs/{self.org_id}/rooms"
-        response = self._make_request('GET', endpoint)
-        data = response.json()
+    async def _make_request(self, method: str, url: str, body: Optional[Dict] = None) -> Dict:
+        """Make API request with rate limiting and retries on transient errors"""
+        async with self._sem:
+            for attempt in range(MAX_RETRIES + 1):
+                if attempt:
+                    await asyncio.sleep(RETRY_BACKOFF_FACTOR * 2 ** (attempt - 1))
+                await self._rate_limit()
+                sent_at = time.monotonic()
+                log.debug("Making %s request to: %s", method, url)
+                try:
+                    response = await self.client.request(method, url, json=body)
+                except httpx.TransportError as e:
+                    if attempt == MAX_RETRIES:
+                        raise
+                    log.debug("Retrying %s %s after %r", method, url, e)
+                    continue
+                
+                self._update_rate_limit(response, sent_at)
+                if response.status_code in RETRY_STATUSES and attempt < MAX_RETRIES:
+                    log.debug("Retrying %s %s after HTTP %d", method, url, response.status_code)
+                    continue  # Transient failure, retry after backoff
+                response.raise_for_status()
+                return json_loads(response.content)
+    
+    def _extract_rooms(self, data) -> List:
+        """Return the rooms in a listing page, probing the response shape only once"""
+        if self._rooms_shape_known:
+            if self._rooms_key is None:
+                if isinstance(data, list):
+                    return data
+            else:
+                try:
+                    return data[self._rooms_key]
+                except (KeyError, TypeError):
+                    pass  # Shape changed between pages, probe again
         
         # Handle different response structures
         if isinstance(data, dict):
-            rooms = data.get('rooms', data.get('data', data.get('items', [])))
+            self._rooms_key = next((key for key in ROOMS_KEYS if key in data), None)
+            if self._rooms_key is None:
+                return []
+        elif isinstance(data, list):
+            self._rooms_key = None
         else:
-            rooms = data if isinstance(data, list) else []
+            return []
         
-        return rooms
+        self._rooms_shape_known = True
+        return data[self._rooms_key] if self._rooms_key else data
     
-    def regenerate_device_enrollment_code(self, room_id: str) -> Optional[str]:
+    async def iter_rooms(self) -> AsyncIterator[Dict]:
+        """Yield all rooms for the organization, following pagination links"""
+        url = self._rooms_url
+        while url:
+            data = await self._make_request('GET', url)
+            rooms = self._extract_rooms(data)
+            
+            # Only object-shaped responses carry pagination links
+            next_url = None
+            if self._rooms_key:
+                next_url = data.get('next') or (data.get('links') or {}).get('next')
+            # Links may be relative, so resolve them against the page they came from
+            url = urljoin(url, next_url) if next_url else None
+            
+            for room in rooms:
+                yield room
+    
+    async def regenerate_device_enrollment_code(self, room_id: str) -> Optional[str]:
         """Generate device enrollment code for a room"""
-        endpoint = f"orgs/{self.org_id}/rooms/{room_id}/regenerate_dec"
+        url = f"{self._rooms_url}/{room_id}/regenerate_dec"
         
         try:
-            response = self._make_request('POST', endpoint)
-            result = response.json()
+            result = await self._make_request('POST', url)
             return result.get('dec') or result.get('deviceEnrollmentCode') or result.get('code')
-        except requests.exceptions.RequestException:
+        except (httpx.HTTPError, ValueError):
             return None
-
-
-def export_to_csv(results: List[Dict], filename: str) -> None:
-    """Export results to CSV file"""
-    if not results:
-        print("No data to export")
-        return
     
-    with open(filename, 'w', newline='', encoding='utf-8') as csvfile:
-        fieldnames = ['room_name', 'room_id', 'device_enrollment_code']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(results)
+    async def regenerate_device_enrollment_codes_bulk(self, room_ids: List[str]) -> Optional[Dict[str, str]]:
+        """Generate device enrollment codes for several rooms in one request
+        
+        Returns a room_id -> DEC map, or None if the batch could not be handled
+        in bulk and should fall back to per-room requests.
+        """
+        if not self._bulk_supported:
+            return None
+        if self._bulk_confirmed:
+            return await self._post_bulk(room_ids)
+        
+        # Until the endpoint is known to work, probe it one batch at a time so
+        # a missing or failing endpoint is only hit once before falling back
+        # to per-room requests
+        async with self._bulk_probe:
+            if not self._bulk_supported:
+                return None
+            return await self._post_bulk(room_ids)
     
-    print(f"Exported {len(results)} rooms to {filename}")
+    async def _post_bulk(self, room_ids: List[str]) -> Optional[Dict[str, str]]:
+        """POST a batch of room IDs to the bulk regenerate_dec endpoint"""
+        url = self._rooms_url + ':regenerate_dec_bulk'
+        try:
+            decs = await self._make_request('POST', url, body={'room_ids': room_ids})
+        except httpx.HTTPStatusError as e:
+            status = e.response.status_code
+            if 400 <= status < 500 and status != 429:
+                self._bulk_supported = False  # Endpoint missing or not accepting this request
+            else:
+                self._bulk_failed()  # Throttled or server error, still failing after retries
+            return None
+        except (httpx.HTTPError, ValueError):
+            self._bulk_failed()
+            return None
+        
+        # Anything but a room_id -> DEC map covering some of the batch is unusable
+        if not isinstance(decs, dict) or not any(room_id in decs for room_id in room_ids):
+            log.warning("Unexpected bulk regenerate_dec response, using per-room requests")
+            self._bulk_failed()
+            return None
+        
+        self._bulk_confirmed = True
+        return decs
+    
+    def _bulk_failed(self) -> None:
+        """Stop using the bulk endpoint if it failed before ever succeeding"""
+        if not self._bulk_confirmed:
+            self._bulk_supported = False
+
+
+def load_dec_cache(filename: str) -> Dict[str, Dict[str, str]]:
+    """Load previously generated DECs, keyed by org ID then room ID"""
+    try:
+        with open(filename, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        log.warning("Ignoring unreadable DEC cache %s", filename)
+        return {}
+
+
+def save_dec_cache(cache: Dict[str, Dict[str, str]], filename: str) -> None:
+    """Write the DEC cache atomically so an interrupted run never corrupts it"""
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w', encoding='utf-8') as f:
+        json.dump(cache, f)
+    os.replace(tmp_filename, filename)
 
 
 def get_room_info(room) -> tuple:
@@ -96,59 +280,254 @@ def get_room_info(room) -> tuple:
     return None, None
 
 
-def main():
+def make_room_extractor(sample) -> Callable:
+    """Build a room ID/name extractor specialised to the schema of a sample room"""
+    if not isinstance(sample, dict):
+        return get_room_info
+    
+    id_key = next((key for key in ('id', 'roomId') if sample.get(key)), None)
+    name_key = next((key for key in ('name', 'roomName') if sample.get(key)), None)
+    if not id_key or not name_key:
+        return get_room_info
+    
+    getter = operator.itemgetter(id_key, name_key)
+    
+    def extract(room) -> tuple:
+        try:
+            room_id, room_name = getter(room)
+        except (KeyError, TypeError):
+            return get_room_info(room)  # Room doesn't match the sampled schema
+        if not room_id or not room_name:
+            return get_room_info(room)
+        return room_id, room_name
+    
+    return extract
+
+
+async def process_room(client: NeatPulseClient, room_id: str, room_name: str) -> tuple:
+    """Generate the DEC for a room, keeping the room metadata alongside it"""
+    dec = await client.regenerate_device_enrollment_code(room_id)
+    return room_id, room_name, dec
+
+
+async def process_batch(client: NeatPulseClient, batch: List[tuple]) -> List[tuple]:
+    """Generate DECs for a batch of rooms, falling back to per-room requests"""
+    decs = await client.regenerate_device_enrollment_codes_bulk([room_id for room_id, _ in batch])
+    if decs is None:
+        decs = {}
+    
+    # Rooms the bulk response has no DEC for go through the per-room endpoint
+    results = [(room_id, room_name, decs[room_id]) for room_id, room_name in batch if decs.get(room_id)]
+    missing = [(room_id, room_name) for room_id, room_name in batch if not decs.get(room_id)]
+    # One room failing unexpectedly must not lose the DECs already regenerated for the rest
+    outcomes = await asyncio.gather(
+        *(process_room(client, room_id, room_name) for room_id, room_name in missing),
+        return_exceptions=True
+    )
+    for (room_id, room_name), outcome in zip(missing, outcomes):
+        if isinstance(outcome, Exception):
+            log.warning("Error generating DEC for %s: %r", room_name, outcome)
+            outcome = (room_id, room_name, None)
+        elif isinstance(outcome, BaseException):
+            raise outcome  # Cancellation
+        results.append(outcome)
+    return results
+
+
+async def produce_rooms(client: NeatPulseClient, queue: asyncio.Queue) -> int:
+    """Queue (room_id, room_name) pairs as room pages arrive, returning the count"""
+    count = 0
+    extract = None
+    try:
+        async for room in client.iter_rooms():
+            if extract is None:
+                extract = make_room_extractor(room)
+            room_id, room_name = extract(room)
+            if room_id:
+                # IDs are kept as strings so they match the JSON keys of the DEC
+                # cache and bulk responses, even when the API returns numbers
+                await queue.put((str(room_id), room_name))
+                count += 1
+        log.info("Found %d rooms", count)
+    except asyncio.CancelledError:
+        raise  # Cancelled by generate_decs, no consumer is waiting for the end marker
+    except Exception:
+        await queue.put(None)  # Let the consumers drain what is queued before failing
+        raise
+    await queue.put(None)  # End marker, passed along by each consumer
+    return count
+
+
+async def next_batch(queue: asyncio.Queue) -> List[tuple]:
+    """Take up to BULK_BATCH_SIZE queued rooms, waiting only for the first
+    
+    Returns an empty list once the producer's end marker is reached.
+    """
+    batch = []
+    item = await queue.get()
+    while item is not None:
+        batch.append(item)
+        if len(batch) == BULK_BATCH_SIZE or queue.empty():
+            return batch
+        item = queue.get_nowait()
+    queue.put_nowait(None)  # Leave the end marker for the other consumers
+    return batch
+
+
+async def consume_rooms(client: NeatPulseClient, queue: asyncio.Queue, writer, csvfile,
+                        cache: Dict[str, Dict[str, str]], force: bool = False) -> int:
+    """Generate DECs for queued rooms until the producer is done
+    
+    Rows are written to the CSV as each batch completes, and rooms with a
+    cached DEC are reported from the cache instead of being regenerated,
+    unless force is set. Returns the number of rows written.
+    """
+    cached_decs = cache.setdefault(client.org_id, {})
+    exported = 0
+    while True:
+        batch = await next_batch(queue)
+        if not batch:
+            return exported
+        
+        rows = []
+        if not force:
+            pending = []
+            for room_id, room_name in batch:
+                if room_id in cached_decs:
+                    log.info("Using cached DEC for %s", room_name)
+                    rows.append((room_name, room_id, cached_decs[room_id]))
+                else:
+                    pending.append((room_id, room_name))
+            batch = pending
+        
+        generated = False
+        if batch:
+            for room_id, room_name, dec in await process_batch(client, batch):
+                if dec:
+                    log.info("Generated DEC for %s", room_name)
+                    rows.append((room_name, room_id, dec))
+                    cached_decs[room_id] = dec
+                    generated = True
+                else:
+                    log.warning("Failed to generate DEC for %s", room_name)
+        
+        if generated:
+            save_dec_cache(cache, DEC_CACHE_FILE)
+        if rows:
+            writer.writerows(rows)
+            csvfile.flush()  # Keep completed rows on disk if the run is interrupted
+            exported += len(rows)
+
+
+async def generate_decs(client: NeatPulseClient, writer, csvfile, cache: Dict[str, Dict[str, str]],
+                        force: bool, concurrency: int) -> tuple:
+    """Run the room listing and DEC generation pipeline
+    
+    Returns the number of rooms found and the number of rows written. The
+    first error from any stage is re-raised once the pipeline has stopped.
+    """
+    queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    producer = asyncio.create_task(produce_rooms(client, queue))
+    consumers = [
+        asyncio.create_task(consume_rooms(client, queue, writer, csvfile, cache, force))
+        for _ in range(concurrency)
+    ]
+    tasks = [producer, *consumers]
+    try:
+        # Consumers stop at the producer's end marker once the queue is drained.
+        # If they all fail instead, nothing drains the queue, so the producer
+        # could block forever on a full queue: stop it as well
+        await asyncio.wait(consumers)
+        if not producer.done():
+            producer.cancel()
+        await asyncio.wait([producer])
+    finally:
+        # On cancellation (e.g. Ctrl-C) stop every stage before returning
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    
+    for task in (*consumers, producer):
+        if not task.cancelled() and task.exception() is not None:
+            raise task.exception()
+    return producer.result(), sum(task.result() for task in consumers)
+
+
+async def main():
     """Main function to process all rooms and generate DECs"""
+    parser = argparse.ArgumentParser(description="Generate NEAT Pulse device enrollment codes for all rooms")
+    parser.add_argument('--force', action='store_true',
+                        help="regenerate DECs even for rooms already in the DEC cache")
+    args = parser.parse_args()
+    
     load_dotenv()
+    log_level = os.getenv('LOG_LEVEL', 'INFO').upper()
+    level_known = isinstance(logging.getLevelName(log_level), int)
+    logging.basicConfig(level=log_level if level_known else logging.INFO, format='%(message)s')
+    logging.getLogger('httpx').setLevel(logging.WARNING)  # Requests are logged at DEBUG below
+    
+    if not level_known:
+        log.error("Error: LOG_LEVEL must be one of DEBUG, INFO, WARNING, ERROR or CRITICAL, got %r",
+                  os.getenv('LOG_LEVEL'))
+        return 1
     
     api_key = os.getenv('API_KEY')
     org_id = os.getenv('ORG_ID')
+    concurrency = os.getenv('CONCURRENCY', '8')
     
     if not api_key or not org_id:
-        print("Error: API_KEY and ORG_ID must be set in .env file")
+        log.error("Error: API_KEY and ORG_ID must be set in .env file")
+        return 1
+    
+    if not concurrency.isdigit() or int(concurrency) < 1:
+        log.error("Error: CONCURRENCY must be a whole number of at least 1, got %r", concurrency)
         return 1
+    concurrency = int(concurrency)
     
+    client = None
     try:
-        client = NeatPulseClient(api_key, org_id)
+        client = NeatPulseClient(api_key, org_id, concurrency=concurrency)
         
-        # Get all rooms
-        print("Fetching rooms...")
-        rooms = client.get_rooms()
+        # Fetch room pages and generate DECs concurrently: rooms are queued as
+        # each page arrives and consumed in batches while later pages load
+        log.info("Fetching rooms...")
+        cache = load_dec_cache(DEC_CACHE_FILE)
         
-        if not rooms:
-            print("No rooms found")
-            return 0
-        
-        print(f"Found {len(rooms)} rooms")
-        
-        # Generate DEC for each room
-        results = []
-        for i, room in enumerate(rooms, 1):
-            room_id, room_name = get_room_info(room)
-            
-            if not room_id:
-                continue
-            
-            print(f"Processing {i}/{len(rooms)}: {room_name}")
-            dec = client.regenerate_device_enrollment_code(room_id)
-            
-            if dec:
-                results.append({
-                    'room_name': room_name,
-                    'room_id': room_id,
-                    'device_enrollment_code': dec
-                })
-        
-        # Export results
+        # Rows go to a temporary file that only replaces the previous run's
+        # output once the run succeeds
         csv_filename = "neat_device_enrollment_codes_simple.csv"
-        export_to_csv(results, csv_filename)
+        tmp_filename = csv_filename + '.tmp'
+        with open(tmp_filename, 'w', newline='', encoding='utf-8') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(CSV_HEADER)
+            try:
+                count, exported = await generate_decs(client, writer, csvfile, cache, args.force, concurrency)
+            except BaseException:
+                log.warning("Rows completed before the run stopped were kept in %s", tmp_filename)
+                raise
+        
+        if not count or not exported:
+            os.remove(tmp_filename)
+            log.info("No rooms found" if not count else "No data to export")
+            return 0
         
-        print(f"Successfully generated {len(results)} device enrollment codes")
+        os.replace(tmp_filename, csv_filename)
+        log.info("Successfully exported %d device enrollment codes to %s", exported, csv_filename)
         return 0
         
     except Exception as e:
-        print(f"Error: {e}")
+        log.error("Error: %s", e)
         return 1
+    finally:
+        if client is not None:
+            await client.close()
 
 
 if __name__ == "__main__":
-    exit(main())
\ No newline at end of file
+    try:
+        import uvloop  # libuv-based event loop, not available on Windows
+    except ImportError:
+        uvloop = None
+    # uvloop.run only exists from uvloop 0.18; older releases use the stdlib loop
+    run = getattr(uvloop, 'run', None) or asyncio.run
+    exit(run(main()))
\ No newline at end of file